@@ -1,8 +1,12 @@
 import os
 import json
 import time
+import heapq
+import uuid
+import functools
 import threading
-from datetime import datetime
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 
 # Flask and LINE Bot imports
 from flask import Flask, abort, request
@@ -13,6 +17,7 @@ from linebot.models import *
 # Google services imports
 import pygsheets
 import google.generativeai as genai
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 from google.oauth2 import service_account
 
@@ -51,14 +56,14 @@ gc = pygsheets.authorize(service_account_file='service_account_key.json')
 sheet = gc.open_by_url(os.environ.get("GOOGLESHEET_URL"))
 
 # Firestore setup
-def get_firestore_client_from_env():
+def get_firestore_client_from_env(client_class=firestore.Client):
     firestore_json = os.getenv("FIRESTORE")
     if not firestore_json:
         raise ValueError("FIRESTORE environment variable is not set.")
     
     cred_info = json.loads(firestore_json)
     credentials = service_account.Credentials.from_service_account_info(cred_info)
-    return firestore.Client(credentials=credentials, project=cred_info["project_id"])
+    return client_class(credentials=credentials, project=cred_info["project_id"])
 
 db = get_firestore_client_from_env()
 
@@ -79,9 +84,17 @@ def load_sheet_data():
     cpc_answers = cpc_ws.get_col(9, include_tailing_empty=False)
     cpc_list = cpc_ws.get_col(1, include_tailing_empty=False)
     
-    return main_questions + cpc_questions, main_answers + cpc_answers, cpc_list
+    return main_questions, main_answers, cpc_questions, cpc_answers, cpc_list
 
-questions_in_sheet, answers_in_sheet, cpc_list = load_sheet_data()
+main_questions, main_answers, cpc_questions, cpc_answers, cpc_list = load_sheet_data()
+questions_in_sheet = main_questions + cpc_questions
+answers_in_sheet = main_answers + cpc_answers
+
+# 表單回應 問題 -> 解決方式 對照表（同題重複時以第一筆為準）
+# 熱門查詢只列表單回應的問題，點選後才查得到解決方式
+answer_by_question = {}
+for q, a in zip(main_questions, main_answers):
+    answer_by_question.setdefault(q, a)
 
 # Load synonyms dictionary
 def load_synonyms():
@@ -115,6 +128,152 @@ def get_model():
 
 question_embeddings = get_model().encode(questions_in_sheet)
 
+###############################################################################
+# HOT RANKING COUNTER
+###############################################################################
+
+# 熱門排行設定：統計時間窗、衰減半衰期、回寫熱門排行的間隔與筆數
+HOT_RANKING_WINDOW_SECONDS = 30 * 24 * 60 * 60
+HOT_RANKING_HALF_LIFE_SECONDS = 7 * 24 * 60 * 60
+HOT_RANKING_SNAPSHOT_INTERVAL = 10 * 60
+HOT_RANKING_SNAPSHOT_SIZE = 20
+HOT_RANKING_LOAD_PAGE_SIZE = 500
+
+# 熱門排行快照只由持有Firestore租約的instance回寫（各instance只有自己的計數）
+# 持有者每次回寫時續約，超過租約時間未續約才由其他instance接手
+INSTANCE_ID = uuid.uuid4().hex
+HOT_RANKING_LEASE_COLLECTION = "locks"
+HOT_RANKING_LEASE_DOCUMENT = "hot_ranking_snapshot"
+HOT_RANKING_LEASE_SECONDS = 3 * HOT_RANKING_SNAPSHOT_INTERVAL
+
+class RollingQuestionCounter:
+    """熱門問題滾動計數器
+    ##作法
+    1.只統計時間窗內的回答紀錄，超出時間窗的紀錄自動移除
+    2.每筆紀錄依指數衰減加權，越新的回答權重越高
+    3.權重以固定基準時間換算，新增與移除皆不需重算全部分數
+    4.紀錄需依時間先後加入
+    """
+
+    def __init__(self, window_seconds, half_life_seconds):
+        self.window_seconds = window_seconds
+        self.half_life_seconds = half_life_seconds
+        self._lock = threading.Lock()
+        self._events = deque()
+        self._counts = {}
+        self._weights = {}
+        self._base_time = time.time()
+
+    def _weight(self, timestamp):
+        return 2 ** ((timestamp - self._base_time) / self.half_life_seconds)
+
+    def _rebase(self, now):
+        """基準時間過舊時重新換算權重，避免數值溢位"""
+        factor = 2 ** ((self._base_time - now) / self.half_life_seconds)
+        self._weights = {q: w * factor for q, w in self._weights.items()}
+        self._events = deque((t, q, w * factor) for t, q, w in self._events)
+        self._base_time = now
+
+    def _expire(self, now):
+        cutoff = now - self.window_seconds
+        while self._events and self._events[0][0] < cutoff:
+            _, question, weight = self._events.popleft()
+            self._counts[question] -= 1
+            if self._counts[question] == 0:
+                del self._counts[question]
+                del self._weights[question]
+            else:
+                self._weights[question] -= weight
+
+    def add(self, question, timestamp=None):
+        """加入一筆回答紀錄"""
+        now = time.time()
+        if timestamp is None:
+            timestamp = now
+        with self._lock:
+            if now - self._base_time > 32 * self.half_life_seconds:
+                self._rebase(now)
+            weight = self._weight(timestamp)
+            self._events.append((timestamp, question, weight))
+            self._counts[question] = self._counts.get(question, 0) + 1
+            self._weights[question] = self._weights.get(question, 0.0) + weight
+            self._expire(now)
+
+    def top(self, n, include=None):
+        """取得熱度最高的前n個問題，回傳 [(問題, 熱度)]
+        include 可傳入篩選函數，只排名符合條件的問題
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            candidates = self._weights.items()
+            if include is not None:
+                candidates = [(q, w) for q, w in candidates if include(q)]
+            ranked = heapq.nlargest(n, candidates, key=lambda x: x[1])
+            factor = 2 ** ((self._base_time - now) / self.half_life_seconds)
+        return [(question, weight * factor) for question, weight in ranked]
+
+# 以回答工作表中時間窗內的紀錄初始化熱門計數
+# 回答工作表最新的紀錄在最上方，分頁讀取到超出時間窗即停止
+def load_hot_question_counter():
+    counter = RollingQuestionCounter(
+        HOT_RANKING_WINDOW_SECONDS, HOT_RANKING_HALF_LIFE_SECONDS
+    )
+    cutoff = time.time() - HOT_RANKING_WINDOW_SECONDS
+    events = []
+    try:
+        reply_ws = sheet.worksheet("title", "回答")
+        start_row = 2
+        reached_cutoff = False
+        while not reached_cutoff and start_row <= reply_ws.rows:
+            end_row = min(start_row + HOT_RANKING_LOAD_PAGE_SIZE - 1, reply_ws.rows)
+            rows = reply_ws.get_values(
+                (start_row, 1), (end_row, 2), include_tailing_empty_rows=False
+            )
+            if not rows:
+                break
+            
+            for row in rows:
+                if len(row) < 2 or not row[1].strip():
+                    continue
+                try:
+                    timestamp = GMT_8.localize(
+                        datetime.strptime(row[0].strip(), "%Y-%m-%d %H:%M:%S")
+                    ).timestamp()
+                except ValueError:
+                    continue
+                if timestamp < cutoff:
+                    reached_cutoff = True
+                    break
+                events.append((timestamp, row[1].strip()))
+            
+            start_row = end_row + 1
+    except Exception as e:
+        print(f"Error in load_hot_question_counter: {str(e)}")
+    
+    for timestamp, question in sorted(events):
+        counter.add(question, timestamp)
+    
+    print(f"Loaded {len(events)} answer records into hot ranking counter.")
+    return counter
+
+hot_question_counter = load_hot_question_counter()
+_last_hot_ranking_snapshot = time.time()
+_hot_ranking_snapshot_lock = threading.Lock()
+
+def record_hot_question(question):
+    """更新熱門計數，回傳是否該回寫熱門排行快照（由呼叫端決定如何在背景執行）"""
+    global _last_hot_ranking_snapshot
+    hot_question_counter.add(question)
+    
+    with _hot_ranking_snapshot_lock:
+        now = time.time()
+        if now - _last_hot_ranking_snapshot < HOT_RANKING_SNAPSHOT_INTERVAL:
+            return False
+        _last_hot_ranking_snapshot = now
+    
+    return True
+
 ###############################################################################
 # SEARCH AND RETRIEVAL FUNCTIONS
 ###############################################################################
@@ -177,10 +336,6 @@ def retrieve_top_n(query, n=2, threshold=5, high_threshold=10):
                 }
                 for i in high_score_indices[:n]
             ]
-            threading.Thread(
-                target=record_question_for_answer,
-                args=(questions_in_sheet[high_score_indices[0]],),
-            ).start()
         else:
             # 如果沒有或只有一個高分結果，只返回最高分的一個
             i = sorted_indices[0]
@@ -193,10 +348,6 @@ def retrieve_top_n(query, n=2, threshold=5, high_threshold=10):
                     "combined_score": float(combined_scores[i]),
                 }
             ]
-            threading.Thread(
-                target=record_question_for_answer,
-                args=(questions_in_sheet[sorted_indices[0]],),
-            ).start()
         
         return result
     except Exception as e:
@@ -207,10 +358,9 @@ def retrieve_top_n(query, n=2, threshold=5, high_threshold=10):
 # LLM AND RESPONSE PROCESSING
 ###############################################################################
 
-def reply_by_LLM(finalanswer, model):
-    """使用LLM生成自然語言回覆"""
-    try:
-        prompt = f"""你是知識問答客服，請將{ finalanswer }直接轉成自然語言。
+def build_llm_prompt(finalanswer):
+    """建立LLM回覆用的提示詞"""
+    return f"""你是知識問答客服，請將{ finalanswer }直接轉成自然語言。
         ##條件
         1.口氣禮貌親切簡潔，像是和使用者對話
         2.若finalanswer為空[]，則回覆:此問題目前找不到合適解答，請聯絡積慧幫忙協助
@@ -218,7 +368,11 @@ def reply_by_LLM(finalanswer, model):
         4.不要解釋以上回覆條件，直接回覆答案
         5.不要反問使用者
         """
-        answer_in_human = model.generate_content(prompt)
+
+def reply_by_LLM(finalanswer, model):
+    """使用LLM生成自然語言回覆"""
+    try:
+        answer_in_human = model.generate_content(build_llm_prompt(finalanswer))
         return answer_in_human
     except Exception as e:
         print(f"Error in reply_by_LLM: {str(e)}")
@@ -247,6 +401,14 @@ def find_closest_question_and_llm_reply(query):
                 "top_matches": [],
             }
         
+        # 記錄本次回覆的問題（熱門計數 + 回答工作表）
+        matched_question = top_matches[0]["question"]
+        if record_hot_question(matched_question):
+            threading.Thread(target=write_hot_ranking_snapshot).start()
+        threading.Thread(
+            target=record_question_for_answer, args=(matched_question,)
+        ).start()
+        
         answers_only = [match["answer"] for match in top_matches]
         result = reply_by_LLM(answers_only, generation_model)
         answer_to_line = extract_chinese_results_new(result)
@@ -263,34 +425,19 @@ def find_closest_question_and_llm_reply(query):
 # DATA RETRIEVAL FUNCTIONS
 ###############################################################################
 
-def get_top_questions():
-    """獲取熱門問題前5名"""
-    try:
-        ranking_ws = sheet.worksheet("title", "熱門排行")
-        print("Found '熱門排行' worksheet.")
-    except pygsheets.WorksheetNotFound:
-        print("熱門排行 worksheet not found.")
-        return []
-    
-    top_ranking_records = ranking_ws.get_all_records()[:5]
+def get_top_questions(n=5):
+    """獲取熱門問題前5名（由記憶體中的熱門計數提供）"""
     top_questions = []
+    ranked = hot_question_counter.top(n, include=answer_by_question.__contains__)
+    for rank, (question, _) in enumerate(ranked, start=1):
+        top_questions.append({
+            "排名": rank,
+            "項目": question,
+            "問題描述": question,
+            "解決方式": answer_by_question[question],
+        })
     
-    main_ws = sheet.worksheet("title", "表單回應")
-    main_records = main_ws.get_all_records()
-    
-    for record in top_ranking_records:
-        full_question = next(
-            (item for item in main_records if item["問題描述"] == record["項目"]), None
-        )
-        if full_question:
-            top_questions.append({
-                "排名": record["排名"],
-                "項目": record["項目"],
-                "問題描述": full_question["問題描述"],
-                "解決方式": full_question["解決方式"],
-            })
-    
-    print(f"Top 5 questions with descriptions: {top_questions}")
+    print(f"Top {n} questions with descriptions: {top_questions}")
     return top_questions
 
 def get_unique_categories():
@@ -361,8 +508,6 @@ def get_oil_points_column_a():
 
 def record_question(user_id, user_input):
     """記錄用戶問題到統計紀錄"""
-    gc = pygsheets.authorize(service_account_file='service_account_key.json')
-    sheet = gc.open_by_url(os.environ.get("GOOGLESHEET_URL"))
     try:
         profile = line_bot_api.get_profile(user_id)
         user_name = profile.display_name
@@ -371,6 +516,12 @@ def record_question(user_id, user_input):
         user_name = "Unknown"
         print(f"Error getting user profile: {e}")
     
+    append_question_record(user_id, user_name, user_input)
+
+def append_question_record(user_id, user_name, user_input):
+    """寫入一筆用戶問題到統計紀錄工作表"""
+    gc = pygsheets.authorize(service_account_file='service_account_key.json')
+    sheet = gc.open_by_url(os.environ.get("GOOGLESHEET_URL"))
     try:
         stats_ws = sheet.worksheet("title", "統計紀錄")
         print("Found '統計紀錄' worksheet.")
@@ -401,6 +552,59 @@ def record_question_for_answer(question_for_answer):
     reply_ws.insert_rows(row=1, values=record_data, inherit=True)
     print(f"Recorded question: {record_data}")
 
+def acquire_hot_ranking_lease():
+    """取得或續約熱門排行回寫租約，同一時間只有一個instance能回寫"""
+    lease_ref = db.collection(HOT_RANKING_LEASE_COLLECTION).document(
+        HOT_RANKING_LEASE_DOCUMENT
+    )
+    
+    @firestore.transactional
+    def acquire(transaction):
+        snapshot = lease_ref.get(transaction=transaction)
+        lease = snapshot.to_dict() if snapshot.exists else {}
+        now = time.time()
+        held_by_other = lease.get("holder") not in (None, INSTANCE_ID)
+        if held_by_other and lease.get("expires_at", 0) > now:
+            return False
+        transaction.set(lease_ref, {
+            "holder": INSTANCE_ID,
+            "expires_at": now + HOT_RANKING_LEASE_SECONDS,
+        })
+        return True
+    
+    return acquire(db.transaction())
+
+def write_hot_ranking_snapshot():
+    """將記憶體中的熱門排行快照回寫到熱門排行工作表"""
+    try:
+        if not acquire_hot_ranking_lease():
+            print("Hot ranking snapshot lease held by another instance.")
+            return
+        
+        gc = pygsheets.authorize(service_account_file='service_account_key.json')
+        sheet = gc.open_by_url(os.environ.get("GOOGLESHEET_URL"))
+        try:
+            ranking_ws = sheet.worksheet("title", "熱門排行")
+        except pygsheets.WorksheetNotFound:
+            ranking_ws = sheet.add_worksheet("熱門排行")
+            print("Created '熱門排行' worksheet.")
+        
+        rows = [["排名", "項目", "熱度"]] + [
+            [rank, question, round(score, 4)]
+            for rank, (question, score) in enumerate(
+                hot_question_counter.top(HOT_RANKING_SNAPSHOT_SIZE), start=1
+            )
+        ]
+        # 先寫入新資料再清除多餘的舊資料，避免讀取時看到空白工作表
+        ranking_ws.update_values("A1", rows)
+        if ranking_ws.rows > len(rows):
+            ranking_ws.clear(start=(len(rows) + 1, 1))
+        if ranking_ws.cols > len(rows[0]):
+            ranking_ws.clear(start=(1, len(rows[0]) + 1))
+        print(f"Wrote hot ranking snapshot with {len(rows) - 1} items.")
+    except Exception as e:
+        print(f"Error in write_hot_ranking_snapshot: {str(e)}")
+
 ###############################################################################
 # UI AND FLEX MESSAGE FUNCTIONS
 ###############################################################################
@@ -537,17 +741,172 @@ def build_flex_response(answer, conversation_id):
     )
 
 ###############################################################################
-# LINE BOT EVENT HANDLERS
+# EVENT DEDUPLICATION
 ###############################################################################
 
-@app.route("/callback", methods=["POST"])
-def callback(request):
-    print(f"Version Code: {VERSION_CODE}")
+# 事件去重設定：記憶體保留時間與筆數上限；EVENT_DEDUP_STORE=firestore 時跨instance共用
+EVENT_DEDUP_TTL_SECONDS = 24 * 60 * 60
+EVENT_DEDUP_MAX_SIZE = 10000
+EVENT_DEDUP_FIRESTORE = os.environ.get("EVENT_DEDUP_STORE", "memory") == "firestore"
+EVENT_DEDUP_COLLECTION = "processed_events"
+
+class ProcessedEventCache:
+    """已處理webhook事件的記憶體TTL集合
+    ##作法
+    1.以webhook event id為key，記錄首次處理時間
+    2.超過TTL的紀錄視為過期，可再次處理
+    3.筆數超過上限時淘汰最舊的紀錄
+    """
+
+    def __init__(self, ttl_seconds, max_size):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+
+    def _expire(self, now):
+        cutoff = now - self.ttl_seconds
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def claim(self, event_id):
+        """標記事件為處理中，首次出現回傳True，重複回傳False"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now
+            self._expire(now)
+            return True
+
+    def release(self, event_id):
+        """移除事件標記（處理失敗時呼叫，讓重送的事件可再處理）"""
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+processed_events = ProcessedEventCache(EVENT_DEDUP_TTL_SECONDS, EVENT_DEDUP_MAX_SIZE)
+
+def get_webhook_event_id(event):
+    return getattr(event, "webhook_event_id", None)
+
+def is_redelivery(event):
+    delivery_context = getattr(event, "delivery_context", None)
+    return bool(getattr(delivery_context, "is_redelivery", False))
+
+def build_processed_event_record(event):
+    """建立寫入Firestore processed_events的紀錄（expire_at 可搭配TTL政策清除）"""
+    return {
+        "event_type": event.type,
+        "is_redelivery": is_redelivery(event),
+        "expire_at": datetime.now(GMT_8) + timedelta(seconds=EVENT_DEDUP_TTL_SECONDS),
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+
+# claim_event 的回傳值：略過、直接處理、背景寫入Firestore標記、以create確認後處理
+EVENT_SKIP = "skip"
+EVENT_PROCESS = "process"
+EVENT_MARK = "mark"
+EVENT_CLAIM = "claim"
+
+def claim_event(event):
+    """事件去重的共用判斷（同步與非同步版本只差在Firestore的呼叫）
+    ##作法
+    1.先查記憶體TTL集合，同一instance內的重送直接略過
+    2.未啟用Firestore或沒有event id時直接處理
+    3.重送事件需以create確認是否已有其他instance處理
+    4.首次送達的事件只在背景寫入紀錄，不阻塞回覆
+    5.處理失敗時需呼叫 release_event 並刪除Firestore標記，LINE重送時才會再處理
+    """
+    event_id = get_webhook_event_id(event)
+    if not event_id:
+        return EVENT_PROCESS
     
-    signature = request.headers.get("X-Line-Signature")
-    body = request.get_data(as_text=True)
-    print("Request body:", body)
+    if not processed_events.claim(event_id):
+        print(f"Skip duplicate event: {event_id}")
+        return EVENT_SKIP
+    
+    if not EVENT_DEDUP_FIRESTORE:
+        return EVENT_PROCESS
+    
+    return EVENT_CLAIM if is_redelivery(event) else EVENT_MARK
+
+def release_event(event):
+    """處理失敗時移除記憶體標記"""
+    event_id = get_webhook_event_id(event)
+    if event_id:
+        processed_events.release(event_id)
+        print(f"Released failed event: {event_id}")
+
+def write_processed_event_marker(doc_ref, record):
+    """寫入首次送達事件的Firestore標記（背景執行）"""
+    try:
+        doc_ref.set(record)
+    except Exception as e:
+        print(f"Error in write_processed_event_marker: {str(e)}")
+
+def delete_processed_event_marker(doc_ref):
+    """刪除處理失敗事件的Firestore標記"""
+    try:
+        doc_ref.delete()
+    except Exception as e:
+        print(f"Error in delete_processed_event_marker: {str(e)}")
+
+def deduplicate_event(handle):
+    """webhook事件處理的去重包裝：重複事件略過，處理失敗時釋放標記"""
+    @functools.wraps(handle)
+    def wrapper(event):
+        action = claim_event(event)
+        if action == EVENT_SKIP:
+            return
+        
+        doc_ref = None
+        marker_thread = None
+        if action in (EVENT_MARK, EVENT_CLAIM):
+            event_id = get_webhook_event_id(event)
+            doc_ref = db.collection(EVENT_DEDUP_COLLECTION).document(event_id)
+            record = build_processed_event_record(event)
+        
+        if action == EVENT_CLAIM:
+            try:
+                doc_ref.create(record)
+            except AlreadyExists:
+                print(f"Skip duplicate event: {event_id}")
+                return
+            except Exception as e:
+                print(f"Error in deduplicate_event: {str(e)}")
+        elif action == EVENT_MARK:
+            marker_thread = threading.Thread(
+                target=write_processed_event_marker, args=(doc_ref, record)
+            )
+            marker_thread.start()
+        
+        try:
+            return handle(event)
+        except Exception:
+            release_event(event)
+            if marker_thread is not None:
+                marker_thread.join()
+            if doc_ref is not None:
+                delete_processed_event_marker(doc_ref)
+            raise
     
+    return wrapper
+
+def build_conversation_id(event):
+    """以webhook event id建立對話ID，重送時ID相同；缺少時改用隨機ID"""
+    event_id = get_webhook_event_id(event)
+    return f"conv_{event_id or uuid.uuid4().hex}"
+
+###############################################################################
+# LINE BOT EVENT HANDLERS
+###############################################################################
+
+def validate_destination(body):
+    """檢查webhook的destination，不符時回傳 (訊息, 狀態碼)，通過回傳None"""
     try:
         payload = json.loads(body)
         if payload.get("destination") != ALLOWED_DESTINATION:
@@ -556,6 +915,19 @@ def callback(request):
     except Exception as e:
         print("Payload parsing error:", e)
         return "Bad Request", 400
+    return None
+
+@app.route("/callback", methods=["POST"])
+def callback(request):
+    print(f"Version Code: {VERSION_CODE}")
+    
+    signature = request.headers.get("X-Line-Signature")
+    body = request.get_data(as_text=True)
+    print("Request body:", body)
+    
+    error = validate_destination(body)
+    if error:
+        return error
     
     try:
         handler.handle(body, signature)
@@ -565,11 +937,8 @@ def callback(request):
         abort(400)
     return "OK"
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    user_input = event.message.text
-    user_id = event.source.user_id
-    
+def build_menu_reply(user_input):
+    """處理選單類指令的回覆，非選單指令回傳None"""
     if user_input.startswith("知識寶典") or user_input.startswith("返回問題分類"):
         reply = create_category_and_common_features()
         print("Displayed category and common features message.")
@@ -639,27 +1008,57 @@ def handle_message(event):
         print("Displayed '中油兌換點數' column A.")
     
     else:
+        return None
+    
+    return reply
+
+def build_conversation_record(conversation_id, user_id, user_input, result_bundle):
+    """建立寫入Firestore conversations的對話紀錄"""
+    top1 = result_bundle["top_matches"][0]
+    return {
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "question": user_input,
+        "answer": result_bundle["answer"],
+        "matched_question": top1["question"],
+        "bm25_score": top1["bm25_score"],
+        "semantic_score": top1["semantic_score"],
+        "combined_score": top1["combined_score"],
+        "model_version": VERSION_CODE,
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+
+def parse_postback_feedback(event):
+    """解析回饋按鈕的postback資料"""
+    data = event.postback.data
+    params = dict(x.split("=") for x in data.split("&"))
+    return {
+        "user_id": event.source.user_id,
+        "conversation_id": params.get("conv_id"),
+        "feedback_type": params.get("feedback"),
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+
+@handler.add(MessageEvent, message=TextMessage)
+@deduplicate_event
+def handle_message(event):
+    user_input = event.message.text
+    user_id = event.source.user_id
+    
+    reply = build_menu_reply(user_input)
+    if reply is None:
         try:
             result_bundle = find_closest_question_and_llm_reply(user_input)
-            conversation_id = f"conv_{user_id}_{int(time.time())}"
+            conversation_id = build_conversation_id(event)
             reply = build_flex_response(result_bundle["answer"], conversation_id)
             print(f"Show LLM answer for question: {user_input}")
             
             if result_bundle["top_matches"]:
-                top1 = result_bundle["top_matches"][0]
-                
-                db.collection("conversations").add({
-                    "conversation_id": conversation_id,
-                    "user_id": user_id,
-                    "question": user_input,
-                    "answer": result_bundle["answer"],
-                    "matched_question": top1["question"],
-                    "bm25_score": top1["bm25_score"],
-                    "semantic_score": top1["semantic_score"],
-                    "combined_score": top1["combined_score"],
-                    "model_version": VERSION_CODE,
-                    "timestamp": firestore.SERVER_TIMESTAMP
-                })
+                db.collection("conversations").document(conversation_id).set(
+                    build_conversation_record(
+                        conversation_id, user_id, user_input, result_bundle
+                    )
+                )
         
         except Exception as e:
             print(f"Error in find_closest_question_and_llm_reply: {str(e)}")
@@ -675,20 +1074,10 @@ def handle_message(event):
     threading.Thread(target=record_question, args=(user_id, user_input)).start()
 
 @handler.add(PostbackEvent)
+@deduplicate_event
 def handle_postback(event):
     """處理用戶回饋"""
-    data = event.postback.data
-    params = dict(x.split("=") for x in data.split("&"))
-    feedback_type = params.get("feedback")
-    conversation_id = params.get("conv_id")
-    user_id = event.source.user_id
-    
-    db.collection("feedback").add({
-        "user_id": user_id,
-        "conversation_id": conversation_id,
-        "feedback_type": feedback_type,
-        "timestamp": firestore.SERVER_TIMESTAMP
-    })
+    db.collection("feedback").add(parse_postback_feedback(event))
     
     line_bot_api.reply_message(
         event.reply_token, TextSendMessage(text="感謝您的回饋 🙏")
@@ -0,0 +1,298 @@
+"""TSCBot 的 asyncio 服務入口
+
+與 tscbot.py 共用資料載入、檢索與選單邏輯，對外呼叫改為非同步：
+LINE 使用 AsyncLineBotApi（aiohttp）、Gemini 使用 generate_content_async、
+Firestore 使用 AsyncClient；CPU密集的檢索與 pygsheets 讀寫則交給 executor，
+讓單一 instance 等待 Gemini 時不需佔用大量執行緒。
+
+啟動方式：python tscbot_async.py
+"""
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import MessageEvent, PostbackEvent, TextMessage, TextSendMessage
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+import tscbot
+
+###############################################################################
+# CONFIGURATION AND INITIALIZATION
+###############################################################################
+
+# 檢索（BM25 + 句向量）專用的執行緒數
+RETRIEVAL_WORKERS = os.cpu_count() or 1
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS)
+
+# 背景紀錄（回答、統計紀錄、熱門排行快照）專用的執行緒數
+# 選單回覆使用預設executor，不會排在背景寫入之後
+LOGGING_WORKERS = 4
+logging_executor = ThreadPoolExecutor(max_workers=LOGGING_WORKERS)
+
+parser = WebhookParser(os.environ.get("LINE_BOT_CHANNEL_SECRET"))
+async_db = tscbot.get_firestore_client_from_env(firestore.AsyncClient)
+
+# 於 on_startup 建立（需在 event loop 內建立 aiohttp session）
+http_session = None
+line_bot_api = None
+
+# 保留背景工作的參照，避免尚未完成就被回收
+_background_tasks = set()
+
+def spawn_background(coro):
+    """在背景執行coroutine，不等待結果"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def run_blocking(func, *args):
+    """在背景紀錄executor執行阻塞的I/O函數（如 pygsheets），錯誤只記錄不拋出"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(logging_executor, func, *args)
+    except Exception as e:
+        print(f"Error in {func.__name__}: {str(e)}")
+
+async def init_clients(app):
+    global http_session, line_bot_api
+    http_session = aiohttp.ClientSession()
+    line_bot_api = AsyncLineBotApi(
+        os.environ.get("LINE_BOT_CHANNEL_ACCESS_TOKEN"),
+        AiohttpAsyncHttpClient(http_session),
+    )
+
+async def close_clients(app):
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await http_session.close()
+    retrieval_executor.shutdown(wait=False)
+    logging_executor.shutdown(wait=False)
+
+###############################################################################
+# LLM AND RESPONSE PROCESSING
+###############################################################################
+
+async def reply_by_LLM_async(finalanswer, model):
+    """使用LLM生成自然語言回覆（非同步）"""
+    try:
+        return await model.generate_content_async(tscbot.build_llm_prompt(finalanswer))
+    except Exception as e:
+        print(f"Error in reply_by_LLM_async: {str(e)}")
+        return None
+
+async def find_closest_question_and_llm_reply_async(query):
+    """主要的問答處理函數（非同步）"""
+    try:
+        loop = asyncio.get_running_loop()
+        top_matches = await loop.run_in_executor(
+            retrieval_executor, tscbot.retrieve_top_n, query
+        )
+        if not top_matches:
+            return {
+                "answer": "目前找不到合適的答案，請再試一次或換個問法",
+                "top_matches": [],
+            }
+        
+        # 記錄本次回覆的問題，回答工作表與快照寫入交給背景紀錄executor
+        matched_question = top_matches[0]["question"]
+        if tscbot.record_hot_question(matched_question):
+            spawn_background(run_blocking(tscbot.write_hot_ranking_snapshot))
+        spawn_background(
+            run_blocking(tscbot.record_question_for_answer, matched_question)
+        )
+        
+        answers_only = [match["answer"] for match in top_matches]
+        result = await reply_by_LLM_async(answers_only, tscbot.generation_model)
+        answer_to_line = tscbot.extract_chinese_results_new(result)
+        return {"answer": answer_to_line, "top_matches": top_matches}
+    
+    except Exception as e:
+        print(f"Error in find_closest_question_and_llm_reply_async: {str(e)}")
+        return {
+            "answer": "此問題目前找不到合適解答，請聯絡積慧幫忙協助",
+            "top_matches": [],
+        }
+
+###############################################################################
+# LOGGING FUNCTIONS
+###############################################################################
+
+async def record_question_async(user_id, user_input):
+    """記錄用戶問題到統計紀錄（非同步）"""
+    try:
+        profile = await line_bot_api.get_profile(user_id)
+        user_name = profile.display_name
+        print(f"Fetched user profile: {user_name}")
+    except (LineBotApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        user_name = "Unknown"
+        print(f"Error getting user profile: {e}")
+    
+    await run_blocking(tscbot.append_question_record, user_id, user_name, user_input)
+
+###############################################################################
+# EVENT DEDUPLICATION
+###############################################################################
+
+async def write_processed_event_marker_async(doc_ref, record):
+    """寫入首次送達事件的Firestore標記（背景執行）"""
+    try:
+        await doc_ref.set(record)
+    except Exception as e:
+        print(f"Error in write_processed_event_marker_async: {str(e)}")
+
+async def delete_processed_event_marker_async(doc_ref):
+    """刪除處理失敗事件的Firestore標記"""
+    try:
+        await doc_ref.delete()
+    except Exception as e:
+        print(f"Error in delete_processed_event_marker_async: {str(e)}")
+
+def deduplicate_event_async(handle):
+    """webhook事件處理的去重包裝（判斷邏輯見 tscbot.claim_event）"""
+    @functools.wraps(handle)
+    async def wrapper(event):
+        action = tscbot.claim_event(event)
+        if action == tscbot.EVENT_SKIP:
+            return
+        
+        doc_ref = None
+        marker_task = None
+        if action in (tscbot.EVENT_MARK, tscbot.EVENT_CLAIM):
+            event_id = tscbot.get_webhook_event_id(event)
+            collection = async_db.collection(tscbot.EVENT_DEDUP_COLLECTION)
+            doc_ref = collection.document(event_id)
+            record = tscbot.build_processed_event_record(event)
+        
+        if action == tscbot.EVENT_CLAIM:
+            try:
+                await doc_ref.create(record)
+            except AlreadyExists:
+                print(f"Skip duplicate event: {event_id}")
+                return
+            except Exception as e:
+                print(f"Error in deduplicate_event_async: {str(e)}")
+        elif action == tscbot.EVENT_MARK:
+            marker_task = spawn_background(
+                write_processed_event_marker_async(doc_ref, record)
+            )
+        
+        try:
+            return await handle(event)
+        except Exception:
+            tscbot.release_event(event)
+            if marker_task is not None:
+                await marker_task
+            if doc_ref is not None:
+                await delete_processed_event_marker_async(doc_ref)
+            raise
+    
+    return wrapper
+
+###############################################################################
+# LINE BOT EVENT HANDLERS
+###############################################################################
+
+async def callback(request):
+    print(f"Version Code: {tscbot.VERSION_CODE}")
+    
+    signature = request.headers.get("X-Line-Signature")
+    body = await request.text()
+    print("Request body:", body)
+    
+    error = tscbot.validate_destination(body)
+    if error:
+        text, status = error
+        return web.Response(status=status, text=text)
+    
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError as e:
+        print("InvalidSignatureError:", e)
+        raise web.HTTPBadRequest()
+    
+    results = await asyncio.gather(
+        *(dispatch_event(event) for event in events), return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        # 與Flask版本相同回傳500，讓LINE重送處理失敗的事件
+        for e in errors:
+            print(f"Error in dispatch_event: {str(e)}")
+        return web.Response(status=500, text="Internal Server Error")
+    
+    print("Message handled successfully.")
+    return web.Response(text="OK")
+
+async def dispatch_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        await handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        await handle_postback(event)
+
+@deduplicate_event_async
+async def handle_message(event):
+    user_input = event.message.text
+    user_id = event.source.user_id
+    loop = asyncio.get_running_loop()
+    
+    # 選單類指令需讀取試算表，交給executor處理
+    reply = await loop.run_in_executor(None, tscbot.build_menu_reply, user_input)
+    if reply is None:
+        try:
+            result_bundle = await find_closest_question_and_llm_reply_async(user_input)
+            conversation_id = tscbot.build_conversation_id(event)
+            reply = tscbot.build_flex_response(result_bundle["answer"], conversation_id)
+            print(f"Show LLM answer for question: {user_input}")
+            
+            if result_bundle["top_matches"]:
+                await async_db.collection("conversations").document(conversation_id).set(
+                    tscbot.build_conversation_record(
+                        conversation_id, user_id, user_input, result_bundle
+                    )
+                )
+        
+        except Exception as e:
+            print(f"Error in find_closest_question_and_llm_reply_async: {str(e)}")
+            reply = TextSendMessage(text="機器人暫時無法使用，請聯絡積慧幫忙協助")
+    
+    try:
+        await line_bot_api.reply_message(event.reply_token, reply)
+        print("Reply sent successfully.")
+    except LineBotApiError as e:
+        print(f"Failed to send reply: {e}")
+    
+    # 非同步記錄用戶提問
+    spawn_background(record_question_async(user_id, user_input))
+
+@deduplicate_event_async
+async def handle_postback(event):
+    """處理用戶回饋"""
+    await async_db.collection("feedback").add(tscbot.parse_postback_feedback(event))
+    
+    await line_bot_api.reply_message(
+        event.reply_token, TextSendMessage(text="感謝您的回饋 🙏")
+    )
+
+###############################################################################
+# MAIN APPLICATION
+###############################################################################
+
+def create_app():
+    app = web.Application()
+    app.router.add_post("/callback", callback)
+    app.on_startup.append(init_clients)
+    app.on_cleanup.append(close_clients)
+    return app
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5000))
+    print(f"Running async server on port {port}")
+    web.run_app(create_app(), host="0.0.0.0", port=port)